@@ -0,0 +1,676 @@
+"""
+File-backed storage for uploaded GeoJSON layers.
+
+Each layer is a pair of files in LAYERS_DIR:
+    {layer_id}.geojson    - the FeatureCollection itself
+    {layer_id}.meta.json  - name, bounds, feature count, timestamps
+"""
+
+import gzip
+import logging
+import os
+import queue
+import re
+import shutil
+import sqlite3
+import subprocess
+import threading
+import uuid
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Optional
+
+import ijson
+import orjson
+
+LAYERS_DIR = Path(os.environ.get("URBANGEN_LAYERS_DIR", "data/layers"))
+LAYERS_DIR.mkdir(parents=True, exist_ok=True)
+
+# The path helpers below do plain string concatenation against this prefix:
+# building a pathlib.Path costs ~500 ns per call and every request makes
+# several, while open()/os.* take strings directly.
+_LAYERS_DIR_STR = str(LAYERS_DIR) + os.sep
+
+MARTIN_URL = os.environ.get("MARTIN_URL", "https://mdlaba.ru/tiles")
+
+logger = logging.getLogger("urbangen.layers")
+
+# Coordinate nesting depth per geometry type: how many list levels sit above
+# the innermost [lng, lat] positions. Used to pick the vectorized bounds path.
+_COORD_DEPTH = {
+    "Point": 0,
+    "MultiPoint": 1,
+    "LineString": 1,
+    "MultiLineString": 2,
+    "Polygon": 2,
+    "MultiPolygon": 3,
+}
+
+# Parsed metadata keyed by layer_id, valid while the file's mtime_ns matches.
+# Metadata files are tiny but read on every metadata endpoint hit; the cache
+# turns those reads into a dict lookup. Guarded by a lock since FastAPI may
+# serve requests from multiple threads.
+_meta_cache: dict[str, tuple[int, dict[str, Any]]] = {}
+_meta_lock = threading.Lock()
+
+# Serialized /layers payload, invalidated on any save or delete. Unlike the
+# per-layer cache this is not mtime-validated: the list endpoint is polled far
+# more often than layers change, so one memcpy beats N stats per request.
+_list_cache: Optional[bytes] = None
+_list_etag: Optional[str] = None
+# Bumped on every invalidation; a rebuild only stores its result if the
+# generation it started from is still current, so a write landing mid-rebuild
+# cannot be masked by a stale payload being cached over it.
+_list_gen = 0
+
+# Metadata writes are tiny but sat on the upload path's critical section;
+# they now go through a single writer thread. _pending_meta holds entries
+# whose file has not hit disk yet so reads stay consistent in the meantime.
+_meta_queue: "queue.Queue[Optional[tuple[str, bytes, str, dict[str, Any]]]]" = queue.Queue()
+_pending_meta: dict[str, dict[str, Any]] = {}
+_writer_thread: Optional[threading.Thread] = None
+
+_np = None
+
+
+def _numpy():
+    """Import numpy on first use so server startup stays cheap."""
+    global _np
+    if _np is None:
+        import numpy
+
+        _np = numpy
+    return _np
+
+
+_LAYER_ID_RE = re.compile(r"^[0-9a-f]{8}$")
+
+
+def generate_layer_id() -> str:
+    """Generate a short unique id for a new layer."""
+    # .hex skips building the hyphenated 36-char form just to slice it
+    return uuid.uuid4().hex[:8]
+
+
+def is_valid_layer_id(layer_id: str) -> bool:
+    """
+    True if layer_id has the exact shape generate_layer_id produces.
+
+    Must be checked before any id reaches the path helpers: they concatenate
+    raw strings, so an unvalidated '../..' id could escape LAYERS_DIR.
+    """
+    return _LAYER_ID_RE.fullmatch(layer_id) is not None
+
+
+def get_layer_path(layer_id: str) -> str:
+    return _LAYERS_DIR_STR + layer_id + ".geojson"
+
+
+def get_metadata_path(layer_id: str) -> str:
+    return _LAYERS_DIR_STR + layer_id + ".meta.json"
+
+
+def get_tiles_path(layer_id: str) -> str:
+    return _LAYERS_DIR_STR + layer_id + ".mbtiles"
+
+
+def get_gzip_path(layer_id: str) -> str:
+    return _LAYERS_DIR_STR + layer_id + ".geojson.gz"
+
+
+def _unlink_quiet(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _metadata_writer() -> None:
+    while True:
+        item = _meta_queue.get()
+        try:
+            if item is None:  # shutdown sentinel; queued writes ahead are done
+                return
+            meta_path, payload, layer_id, metadata = item
+            # tmp + os.replace, like the GeoJSON saves: a crash mid-write
+            # must not leave a truncated .meta.json behind.
+            tmp_path = meta_path + ".tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(payload)
+                os.replace(tmp_path, meta_path)
+            except OSError:
+                # Keep consuming: a dead writer would leave join() callers
+                # blocked forever. The entry stays pending so reads still work.
+                logger.exception("background metadata write failed for %s", layer_id)
+                _unlink_quiet(tmp_path)
+                continue
+            with _meta_lock:
+                # Only clear pending if no newer write superseded this one.
+                if _pending_meta.get(layer_id) is metadata:
+                    _pending_meta.pop(layer_id)
+        finally:
+            _meta_queue.task_done()
+
+
+def start_metadata_writer() -> None:
+    """Start the background metadata writer (idempotent)."""
+    global _writer_thread
+    if _writer_thread is not None and _writer_thread.is_alive():
+        return
+    _writer_thread = threading.Thread(target=_metadata_writer, name="meta-writer", daemon=True)
+    _writer_thread.start()
+
+
+def stop_metadata_writer() -> None:
+    """Drain queued metadata writes and stop the writer."""
+    global _writer_thread
+    if _writer_thread is None:
+        return
+    _meta_queue.put(None)
+    _writer_thread.join()
+    _writer_thread = None
+
+
+def _enqueue_metadata_write(layer_id: str, metadata: dict[str, Any]) -> None:
+    """Hand a metadata write to the background writer, updating caches now."""
+    global _list_cache, _list_etag, _list_gen
+    payload = orjson.dumps(metadata, option=orjson.OPT_INDENT_2)
+    with _meta_lock:
+        _meta_cache.pop(layer_id, None)
+        _pending_meta[layer_id] = metadata
+        _list_cache = None
+        _list_etag = None
+        _list_gen += 1
+    start_metadata_writer()  # lazy start covers use outside the app lifespan
+    _meta_queue.put((get_metadata_path(layer_id), payload, layer_id, metadata))
+
+
+def process_coords(coords: Any, bounds: list[Optional[float]]) -> None:
+    """
+    Fold a (possibly nested) coordinate array into running min/max bounds.
+
+    Iterative with an explicit stack: per-level function calls cost ~1 us in
+    CPython and deeply nested MultiPolygons can brush the recursion limit.
+    min/max and the running bounds are held in locals for the hot loop.
+    """
+    if not coords:
+        return
+    _min, _max = min, max
+    lng_min, lat_min, lng_max, lat_max = bounds
+    stack = [coords]
+    while stack:
+        c = stack.pop()
+        if not c:
+            continue
+        if type(c[0]) is list:
+            stack.extend(c)
+        else:
+            lng, lat = c[0], c[1]
+            lng_min = lng if lng_min is None else _min(lng_min, lng)
+            lat_min = lat if lat_min is None else _min(lat_min, lat)
+            lng_max = lng if lng_max is None else _max(lng_max, lng)
+            lat_max = lat if lat_max is None else _max(lat_max, lat)
+    bounds[0] = lng_min
+    bounds[1] = lat_min
+    bounds[2] = lng_max
+    bounds[3] = lat_max
+
+
+def _iter_position_arrays(coords: Any, depth: int):
+    """Yield the innermost position lists (rings/lines) of a coordinate array."""
+    if depth == 1:
+        yield coords
+    elif depth == 2:
+        yield from coords
+    else:
+        for part in coords:
+            yield from part
+
+
+def process_geometry(geometry: dict[str, Any], bounds: list[Optional[float]]) -> None:
+    """
+    Fold one geometry's coordinates into running bounds.
+
+    For the standard geometry types the nesting depth is known, so each
+    ring/line converts to an (N, 2) float64 array whose min/max run in C —
+    20-100x faster than the per-coordinate Python walk on large layers.
+    Anything irregular falls back to the recursive walk.
+    """
+    # Valid geometries always carry these keys; indexing with a broad except
+    # beats per-feature .get() dispatch on 100k-feature collections.
+    try:
+        coords = geometry["coordinates"]
+        geometry_type = geometry["type"]
+    except (KeyError, TypeError):
+        return
+    if not coords:
+        return
+    depth = _COORD_DEPTH.get(geometry_type)
+    if depth is None:
+        process_coords(coords, bounds)
+        return
+    if depth == 0:
+        # Single position; numpy setup costs more than it saves.
+        process_coords(coords, bounds)
+        return
+
+    np = _numpy()
+    for ring in _iter_position_arrays(coords, depth):
+        try:
+            arr = np.asarray(ring, dtype=np.float64)
+        except (TypeError, ValueError):
+            process_coords(ring, bounds)
+            continue
+        if arr.ndim != 2 or arr.shape[0] == 0:
+            process_coords(ring, bounds)
+            continue
+        # float() keeps numpy scalars out of the metadata (orjson rejects them)
+        lng_min = float(arr[:, 0].min())
+        lat_min = float(arr[:, 1].min())
+        lng_max = float(arr[:, 0].max())
+        lat_max = float(arr[:, 1].max())
+        bounds[0] = lng_min if bounds[0] is None else min(bounds[0], lng_min)
+        bounds[1] = lat_min if bounds[1] is None else min(bounds[1], lat_min)
+        bounds[2] = lng_max if bounds[2] is None else max(bounds[2], lng_max)
+        bounds[3] = lat_max if bounds[3] is None else max(bounds[3], lat_max)
+
+
+def summarize_features(features: Any) -> dict[str, Any]:
+    """
+    Compute feature count, leading geometry type, and bounds in one fused
+    pass over an iterable of features.
+    """
+    feature_count = 0
+    geometry_type = None
+    bounds: list[Optional[float]] = [None, None, None, None]
+    for feature in features:
+        feature_count += 1
+        try:
+            geometry = feature["geometry"]
+            if geometry_type is None:
+                geometry_type = geometry["type"]
+            process_geometry(geometry, bounds)
+        except (KeyError, IndexError, TypeError, ValueError):
+            # Null geometry, missing keys, or coordinates that are not valid
+            # position arrays: skip the feature rather than failing the pass.
+            continue
+    return {
+        "feature_count": feature_count,
+        "geometry_type": geometry_type,
+        "bounds": bounds if bounds[0] is not None else None,
+    }
+
+
+def calculate_bounds(features: list[dict[str, Any]]) -> Optional[list[float]]:
+    """Compute [min_lng, min_lat, max_lng, max_lat] over all feature coordinates."""
+    return summarize_features(features)["bounds"]
+
+
+def _write_metadata(
+    layer_id: str,
+    name: str,
+    feature_count: int,
+    geometry_type: Optional[str],
+    bounds: Optional[list[float]],
+    file_size: int,
+) -> dict[str, Any]:
+    """Build a layer's metadata dict, persist it, and return it."""
+    now = datetime.now().isoformat()
+    metadata = {
+        "id": layer_id,
+        "name": name,
+        "feature_count": feature_count,
+        "geometry_type": geometry_type,
+        "bounds": bounds,
+        "file_size": file_size,
+        "tiles_ready": False,
+        "created_at": now,
+        "updated_at": now,
+    }
+
+    existing = get_layer(layer_id)
+    if existing:
+        metadata["created_at"] = existing["created_at"]
+
+    _enqueue_metadata_write(layer_id, metadata)
+    return metadata
+
+
+def save_layer(
+    layer_id: str,
+    name: str,
+    geojson: dict[str, Any],
+    precomputed: Optional[dict[str, Any]] = None,
+) -> dict[str, Any]:
+    """
+    Write an in-memory FeatureCollection and its metadata to disk.
+
+    A caller that already walked the features (e.g. a streaming parser) can
+    pass its accumulated feature_count / geometry_type / bounds as
+    `precomputed` so the collection is not scanned a second time here.
+    """
+    features = geojson.get("features", [])
+
+    # orjson hands back the whole document as one bytes object, so write it
+    # with a single unbuffered syscall instead of going through a buffered
+    # file object; tmp + os.replace keeps the swap atomic.
+    buf = orjson.dumps(geojson)
+    geojson_path = get_layer_path(layer_id)
+    tmp_path = geojson_path + ".tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, buf)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, geojson_path)
+    # A re-save under the same id invalidates any pre-gzipped sibling.
+    _unlink_quiet(get_gzip_path(layer_id))
+
+    summary = precomputed if precomputed is not None else summarize_features(features)
+
+    return _write_metadata(
+        layer_id,
+        name,
+        feature_count=summary["feature_count"],
+        geometry_type=summary.get("geometry_type"),
+        bounds=summary.get("bounds"),
+        file_size=len(buf),
+    )
+
+
+def ingest_layer(
+    layer_id: str,
+    name: str,
+    tmp_path: str,
+    file_size: Optional[int] = None,
+) -> dict[str, Any]:
+    """
+    Validate a FeatureCollection already streamed to tmp_path, summarize it in
+    one pass, and move it into place.
+
+    Features are decoded one at a time with ijson, so peak memory stays O(one
+    feature) no matter how large the upload is. Raises ValueError on invalid
+    input (the tmp file is left for the caller to clean up).
+    """
+    top_type: Optional[str] = None
+
+    def stream_features(f) -> Any:
+        # Single pass over the event stream: captures the collection's
+        # top-level "type" on the way through while yielding one built
+        # feature at a time, so validation and summary share a read.
+        nonlocal top_type
+        parser = ijson.parse(f, use_float=True)
+        for prefix, event, value in parser:
+            if prefix == "type" and event == "string":
+                top_type = value
+            elif prefix == "features.item" and event == "start_map":
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+                for prefix2, event2, value2 in parser:
+                    builder.event(event2, value2)
+                    if prefix2 == "features.item" and event2 == "end_map":
+                        break
+                yield builder.value
+
+    try:
+        with open(tmp_path, "rb") as f:
+            summary = summarize_features(stream_features(f))
+    except ijson.JSONError:
+        raise ValueError("File is not valid JSON")
+    if top_type != "FeatureCollection":
+        raise ValueError("Expected a GeoJSON FeatureCollection")
+
+    # Callers that streamed the upload already know the byte count; only
+    # stat when nothing was passed in.
+    if file_size is None:
+        file_size = os.path.getsize(tmp_path)
+    os.replace(tmp_path, get_layer_path(layer_id))
+
+    return _write_metadata(
+        layer_id,
+        name,
+        feature_count=summary["feature_count"],
+        geometry_type=summary.get("geometry_type"),
+        bounds=summary.get("bounds"),
+        file_size=file_size,
+    )
+
+
+def _load_metadata(layer_id: str, meta_path: str, mtime_ns: int) -> dict[str, Any]:
+    """Return parsed metadata, reusing the cache while the file is unchanged."""
+    with _meta_lock:
+        cached = _meta_cache.get(layer_id)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1]
+    with open(meta_path, "rb") as f:
+        metadata = orjson.loads(f.read())
+    with _meta_lock:
+        _meta_cache[layer_id] = (mtime_ns, metadata)
+    return metadata
+
+
+def ingest_layer_seq(layer_id: str, name: str, tmp_path: str) -> dict[str, Any]:
+    """
+    Ingest a newline-delimited feature stream (GeoJSON-Seq / NDJSON) already
+    streamed to tmp_path, wrapping it into a stored FeatureCollection.
+
+    Lines are decoded one at a time (RFC 7464 RS prefixes are tolerated) and
+    the raw line bytes are written through into the output file, so features
+    are never re-encoded and memory stays O(one feature). Raises ValueError
+    on invalid input (the tmp file is left for the caller to clean up).
+    """
+    feature_count = 0
+    geometry_type: Optional[str] = None
+    bounds: list[Optional[float]] = [None, None, None, None]
+    out_tmp = tmp_path + ".fc"
+
+    try:
+        with open(tmp_path, "rb") as src, open(out_tmp, "wb") as out:
+            out.write(b'{"type":"FeatureCollection","features":[')
+
+            def handle_line(line: bytes) -> None:
+                nonlocal feature_count, geometry_type
+                line = line.strip().lstrip(b"\x1e")  # RS prefix per RFC 7464
+                if not line:
+                    return
+                try:
+                    feature = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    raise ValueError(f"Line {feature_count + 1} is not valid JSON")
+                if not isinstance(feature, dict) or feature.get("type") != "Feature":
+                    raise ValueError(f"Line {feature_count + 1} is not a GeoJSON Feature")
+                if feature_count:
+                    out.write(b",")
+                out.write(line)
+                feature_count += 1
+                try:
+                    geometry = feature["geometry"]
+                    if geometry_type is None:
+                        geometry_type = geometry["type"]
+                    process_geometry(geometry, bounds)
+                except (KeyError, IndexError, TypeError, ValueError):
+                    # Null or malformed geometry: keep the feature, skip bounds.
+                    return
+
+            buffer = b""
+            while chunk := src.read(1 << 20):
+                buffer += chunk
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    handle_line(line)
+            handle_line(buffer)
+
+            out.write(b"]}")
+            file_size = out.tell()
+            out.flush()
+            os.fsync(out.fileno())
+    except Exception:
+        # Bad input or I/O failure alike must not leave the output temp behind.
+        _unlink_quiet(out_tmp)
+        raise
+
+    os.replace(out_tmp, get_layer_path(layer_id))
+    _unlink_quiet(tmp_path)
+
+    return _write_metadata(
+        layer_id,
+        name,
+        feature_count=feature_count,
+        geometry_type=geometry_type,
+        bounds=bounds if bounds[0] is not None else None,
+        file_size=file_size,
+    )
+
+
+def get_layer(layer_id: str) -> Optional[dict[str, Any]]:
+    """Return a layer's metadata, or None if it does not exist."""
+    with _meta_lock:
+        pending = _pending_meta.get(layer_id)
+    if pending is not None:
+        return pending
+    meta_path = get_metadata_path(layer_id)
+    try:
+        st = os.stat(meta_path)
+    except FileNotFoundError:
+        return None
+    return _load_metadata(layer_id, meta_path, st.st_mtime_ns)
+
+
+def list_layers() -> list[dict[str, Any]]:
+    """Return metadata for every stored layer, newest first."""
+    # Settle any queued metadata writes so the directory scan sees them;
+    # returns immediately when nothing is pending.
+    _meta_queue.join()
+    layers = []
+    # os.scandir beats Path.glob here: no per-entry Path/fnmatch overhead, and
+    # entry.stat() comes from the directory scan without an extra syscall.
+    with os.scandir(LAYERS_DIR) as entries:
+        for entry in entries:
+            if entry.name.endswith(".meta.json") and entry.is_file():
+                layer_id = entry.name[: -len(".meta.json")]
+                try:
+                    layers.append(
+                        _load_metadata(layer_id, entry.path, entry.stat().st_mtime_ns)
+                    )
+                except orjson.JSONDecodeError:
+                    # One corrupt file must not take the whole listing down.
+                    logger.warning("skipping unreadable metadata file %s", entry.path)
+    layers.sort(key=lambda layer: layer["created_at"], reverse=True)
+    return layers
+
+
+def list_layers_response() -> tuple[bytes, str]:
+    """Return the serialized /layers body and its ETag, rebuilt only after writes."""
+    global _list_cache, _list_etag
+    with _meta_lock:
+        if _list_cache is not None and _list_etag is not None:
+            return _list_cache, _list_etag
+        gen = _list_gen
+    layers = list_layers()
+    payload = orjson.dumps({"layers": layers, "total": len(layers)})
+    etag = f'"{zlib.crc32(payload):x}-{len(payload):x}"'
+    with _meta_lock:
+        if _list_gen == gen:
+            _list_cache = payload
+            _list_etag = etag
+    return payload, etag
+
+
+def update_layer_metadata(layer_id: str, **fields: Any) -> Optional[dict[str, Any]]:
+    """Merge fields into a layer's stored metadata, or return None if missing."""
+    metadata = get_layer(layer_id)
+    if metadata is None:
+        return None
+    metadata = {**metadata, **fields}
+    # Through the same queue as full writes so updates cannot be overtaken
+    # by an earlier write still in flight.
+    _enqueue_metadata_write(layer_id, metadata)
+    return metadata
+
+
+def generate_tiles(layer_id: str) -> None:
+    """
+    Pre-cut vector tiles for a layer with tippecanoe, flagging the layer
+    tiles_ready on success.
+
+    Runs in the background after upload; a no-op when tippecanoe is not
+    installed, in which case clients keep using the raw /geojson endpoint.
+    """
+    tippecanoe = shutil.which("tippecanoe")
+    if tippecanoe is None:
+        return
+    # Build into a temp sibling and os.replace it so the tile route never
+    # opens a partially written MBTiles.
+    tiles_tmp = get_tiles_path(layer_id) + ".tmp"
+    cmd = [
+        tippecanoe,
+        "--force",
+        "--quiet",
+        "--layer",
+        layer_id,
+        "-o",
+        tiles_tmp,
+        get_layer_path(layer_id),
+    ]
+    try:
+        subprocess.run(cmd, check=True, capture_output=True)
+    except subprocess.CalledProcessError as exc:
+        logger.warning("tippecanoe failed for layer %s: %s", layer_id, exc.stderr)
+        _unlink_quiet(tiles_tmp)
+        return
+    os.replace(tiles_tmp, get_tiles_path(layer_id))
+    update_layer_metadata(layer_id, tiles_ready=True)
+
+
+def compress_layer(layer_id: str) -> None:
+    """
+    Write a gzipped sibling of the layer's GeoJSON so repeat downloads get
+    the ~10x smaller body without paying per-request compression.
+
+    Runs in the background after upload.
+    """
+    src = get_layer_path(layer_id)
+    if not os.path.exists(src):
+        return
+    gz_tmp = get_gzip_path(layer_id) + ".tmp"
+    with open(src, "rb") as fin, gzip.open(gz_tmp, "wb", compresslevel=9) as fout:
+        shutil.copyfileobj(fin, fout, 1 << 20)
+    os.replace(gz_tmp, get_gzip_path(layer_id))
+
+
+def read_tile(layer_id: str, z: int, x: int, y: int) -> Optional[bytes]:
+    """Read one tile from a layer's MBTiles (XYZ input, TMS row flip)."""
+    conn = sqlite3.connect(get_tiles_path(layer_id))
+    try:
+        row = conn.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, (1 << z) - 1 - y),
+        ).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+def delete_layer(layer_id: str) -> bool:
+    """Remove a layer's files. Returns False if the layer does not exist."""
+    # Settle queued metadata writes so a just-uploaded layer cannot have its
+    # file re-created underneath the delete.
+    _meta_queue.join()
+    meta_path = get_metadata_path(layer_id)
+    if not os.path.exists(meta_path):
+        return False
+    _unlink_quiet(get_layer_path(layer_id))
+    _unlink_quiet(get_tiles_path(layer_id))
+    _unlink_quiet(get_gzip_path(layer_id))
+    os.remove(meta_path)
+    global _list_cache, _list_etag, _list_gen
+    with _meta_lock:
+        _meta_cache.pop(layer_id, None)
+        _pending_meta.pop(layer_id, None)
+        _list_cache = None
+        _list_etag = None
+        _list_gen += 1
+    return True
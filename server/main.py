@@ -0,0 +1,42 @@
+"""
+UrbanGen layers API.
+
+Stores user-uploaded GeoJSON layers and serves them back to the frontend.
+Vector tiles for the base datasets come from Martin (see SERVER_INFO.md).
+
+Run with: uvicorn server.main:app --port 3003
+"""
+
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+
+from . import database
+from .routers import layers
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    database.start_metadata_writer()
+    yield
+    # Drain queued metadata writes so nothing is lost on shutdown.
+    database.stop_metadata_writer()
+
+
+app = FastAPI(title="UrbanGen Layers API", lifespan=lifespan)
+
+# Coordinate-heavy JSON compresses ~10x; skip bodies too small to matter.
+# Responses that already carry a Content-Encoding (pre-gzipped GeoJSON,
+# tile blobs) pass through untouched.
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+app.include_router(layers.router)
@@ -0,0 +1,22 @@
+"""Pydantic models for the layers API."""
+
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class LayerInfo(BaseModel):
+    id: str
+    name: str
+    feature_count: int
+    geometry_type: Optional[str] = None
+    bounds: Optional[list[float]] = None
+    file_size: int
+    tiles_ready: bool = False
+    created_at: str
+    updated_at: str
+
+
+class LayerListResponse(BaseModel):
+    layers: list[LayerInfo]
+    total: int
@@ -0,0 +1,170 @@
+"""Routes for uploading, listing and fetching GeoJSON layers."""
+
+import os
+from contextlib import suppress
+from typing import Optional
+
+from fastapi import APIRouter, BackgroundTasks, File, Form, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, Response
+
+from .. import database as db
+from ..models import LayerInfo, LayerListResponse
+
+router = APIRouter(prefix="/layers", tags=["layers"])
+
+# Uploads in these formats are one feature per line (GeoJSON-Seq / NDJSON)
+# and take the line-streaming ingest path instead of the DOM parse.
+_SEQ_CONTENT_TYPES = {"application/geo+json-seq", "application/x-ndjson", "application/ndjson"}
+_SEQ_SUFFIXES = (".geojsonl", ".geojsons", ".ndjson", ".jsonseq")
+
+
+def _is_sequence_upload(file: UploadFile) -> bool:
+    if file.content_type in _SEQ_CONTENT_TYPES:
+        return True
+    return (file.filename or "").lower().endswith(_SEQ_SUFFIXES)
+
+
+def _stat_etag(st: os.stat_result) -> str:
+    # mtime+size is enough to distinguish revisions of our own files and is
+    # far cheaper than hashing the content.
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+def _not_modified(request: Request, etag: str) -> bool:
+    return request.headers.get("if-none-match") == etag
+
+
+def _require_valid_layer_id(layer_id: str) -> None:
+    # The path helpers concatenate raw strings, so anything that is not a
+    # well-formed id must be rejected before it can reach the filesystem.
+    if not db.is_valid_layer_id(layer_id):
+        raise HTTPException(status_code=400, detail="Invalid layer id")
+
+
+# Metadata comes from our own files, so the handlers below return it directly
+# instead of revalidating through LayerInfo; the models stay on the decorators
+# (via `responses`) purely for the OpenAPI docs.
+
+
+@router.post("/upload", responses={200: {"model": LayerInfo}})
+async def upload_layer(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    name: Optional[str] = Form(None),
+) -> JSONResponse:
+    layer_id = db.generate_layer_id()
+
+    # Stream the body straight to a temp file instead of buffering it in RAM;
+    # ingest then summarizes it in a single pass and moves it into place. The
+    # finally sweep keeps aborted or rejected uploads from littering
+    # LAYERS_DIR (a successful ingest has already moved or removed the temp).
+    tmp_path = db.get_layer_path(layer_id) + ".tmp"
+    layer_name = name or file.filename or layer_id
+    try:
+        bytes_written = 0
+        with open(tmp_path, "wb") as tmp:
+            while chunk := await file.read(1 << 20):
+                await run_in_threadpool(tmp.write, chunk)
+                bytes_written += len(chunk)
+            await run_in_threadpool(tmp.flush)
+            await run_in_threadpool(os.fsync, tmp.fileno())
+
+        if _is_sequence_upload(file):
+            metadata = await run_in_threadpool(db.ingest_layer_seq, layer_id, layer_name, tmp_path)
+        else:
+            metadata = await run_in_threadpool(
+                db.ingest_layer, layer_id, layer_name, tmp_path, file_size=bytes_written
+            )
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    finally:
+        with suppress(FileNotFoundError):
+            os.remove(tmp_path)
+
+    # Pre-cut vector tiles once at upload so large layers can be viewed
+    # through tile requests instead of re-downloading the whole GeoJSON.
+    background_tasks.add_task(db.compress_layer, layer_id)
+    background_tasks.add_task(db.generate_tiles, layer_id)
+
+    return JSONResponse(content=metadata)
+
+
+@router.get("", responses={200: {"model": LayerListResponse}})
+async def list_layers(request: Request) -> Response:
+    # The serialized payload is cached until the next save/delete; sending it
+    # as-is skips rebuilding N LayerInfo models per poll.
+    payload, etag = await run_in_threadpool(db.list_layers_response)
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=payload, media_type="application/json", headers={"ETag": etag})
+
+
+@router.get("/{layer_id}", responses={200: {"model": LayerInfo}})
+async def get_layer(layer_id: str, request: Request) -> Response:
+    _require_valid_layer_id(layer_id)
+    layer = await run_in_threadpool(db.get_layer, layer_id)
+    if layer is None:
+        raise HTTPException(status_code=404, detail="Layer not found")
+    try:
+        st = await run_in_threadpool(os.stat, db.get_metadata_path(layer_id))
+    except FileNotFoundError:
+        # Metadata write still queued behind the background writer; serve
+        # the in-memory copy without validators.
+        return JSONResponse(content=layer)
+    etag = _stat_etag(st)
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse(content=layer, headers={"ETag": etag})
+
+
+@router.get("/{layer_id}/geojson")
+async def get_layer_geojson(layer_id: str, request: Request) -> Response:
+    _require_valid_layer_id(layer_id)
+    # The file is already valid JSON on disk; stream it as-is instead of
+    # parsing and re-serializing the whole FeatureCollection per request.
+    # Clients that accept gzip get the pre-compressed sibling when the
+    # background compression has finished.
+    geojson_path = db.get_layer_path(layer_id)
+    try:
+        st = await run_in_threadpool(os.stat, geojson_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Layer not found")
+    # The ETag tracks the raw file so it is stable across the gzip/identity
+    # variants; Vary keeps shared caches from mixing them up.
+    etag = _stat_etag(st)
+    headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        gz_path = db.get_gzip_path(layer_id)
+        if await run_in_threadpool(os.path.exists, gz_path):
+            return FileResponse(
+                gz_path,
+                media_type="application/geo+json",
+                headers={**headers, "Content-Encoding": "gzip"},
+            )
+    return FileResponse(geojson_path, media_type="application/geo+json", headers=headers)
+
+
+@router.get("/{layer_id}/tiles/{z}/{x}/{y}.pbf")
+async def get_layer_tile(layer_id: str, z: int, x: int, y: int) -> Response:
+    _require_valid_layer_id(layer_id)
+    tiles_path = db.get_tiles_path(layer_id)
+    if not await run_in_threadpool(os.path.exists, tiles_path):
+        raise HTTPException(status_code=404, detail="Tiles not ready for this layer")
+    tile = await run_in_threadpool(db.read_tile, layer_id, z, x, y)
+    if tile is None:
+        return Response(status_code=204)
+    headers = {}
+    if tile[:2] == b"\x1f\x8b":  # tippecanoe gzips tile blobs
+        headers["Content-Encoding"] = "gzip"
+    return Response(content=tile, media_type="application/x-protobuf", headers=headers)
+
+
+@router.delete("/{layer_id}")
+async def delete_layer(layer_id: str) -> dict:
+    _require_valid_layer_id(layer_id)
+    if not await run_in_threadpool(db.delete_layer, layer_id):
+        raise HTTPException(status_code=404, detail="Layer not found")
+    return {"status": "deleted", "id": layer_id}